@@ -15,100 +15,125 @@
 # limitations under the License.
 
 import argparse
+import functools
 import os
-import platform
+import re
 import string
 import sys
 
 from jinja2 import Environment
 
-import yaml
-
 from renderspec.distloader import RenderspecLoader
-from renderspec import versions
 from renderspec import contextfuncs
 
+# distro names which are Fedora based
+_FEDORA_RE = re.compile(r'fedora|centos|red hat', re.IGNORECASE)
+
+# characters around /etc/os-release values (which might be quoted)
+_OS_RELEASE_STRIP_CHARS = string.whitespace + '"\''
+
 
 def generate_spec(spec_style, epochs, requirements, skip_pyversion,
                   input_template_format, input_template_path, output_path):
     """generate a spec file with the given style and input template"""
-    if input_template_format == 'spec.j2':
-        return _renderer_input_template_format_spec(
-            spec_style, epochs, requirements, skip_pyversion,
-            input_template_path, output_path)
-    else:
+    return ''.join(generate_spec_stream(
+        spec_style, epochs, requirements, skip_pyversion,
+        input_template_format, input_template_path, output_path))
+
+
+def generate_spec_stream(spec_style, epochs, requirements, skip_pyversion,
+                         input_template_format, input_template_path,
+                         output_path):
+    """like generate_spec() but return a jinja2 TemplateStream which
+    renders the spec piece by piece (e.g. directly into a file)"""
+    try:
+        renderer = _INPUT_TEMPLATE_FORMAT_RENDERERS[input_template_format]
+    except KeyError:
         raise Exception('Unknown input-template-format "%s"' %
                         input_template_format)
+    return renderer(spec_style, epochs, requirements, skip_pyversion,
+                    input_template_path, output_path)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_env(input_template_path, input_template_mtime):
+    """get a (cached) jinja2 environment for the given input template.
+    The environment keeps the compiled templates so rendering the same
+    template again does not need to parse it again. The mtime is part of
+    the cache key so a changed template gets a new environment"""
+    # no need for auto_reload (which checks the template mtime on every
+    # get_template() call) because of the mtime in the cache key
+    env = Environment(loader=RenderspecLoader(
+        template_fn=input_template_path),
+        trim_blocks=True,
+        auto_reload=False)
+
+    contextfuncs.env_register_filters_and_globals(env)
+    return env
 
 
 def _renderer_input_template_format_spec(spec_style, epochs, requirements,
                                          skip_pyversion,
                                          input_template_path, output_path):
-    """render a 'traditional' .spec.j2 template into a .spec file"""
-    env = Environment(loader=RenderspecLoader(
-        template_fn=input_template_path),
-        trim_blocks=True)
-
-    contextfuncs.env_register_filters_and_globals(env)
+    """render a 'traditional' .spec.j2 template into a .spec stream"""
+    env = _get_env(input_template_path,
+                   os.stat(input_template_path).st_mtime_ns)
 
     template_name = '.spec'
     if spec_style in env.loader.list_templates():
         template_name = spec_style
     template = env.get_template(template_name)
-    input_template_dir = os.path.dirname(os.path.abspath(input_template_path))
+    # os.path.abspath() does a getcwd() syscall on every call so use the
+    # working directory directly for both paths
+    cwd = os.getcwd()
+    input_template_dir = os.path.dirname(
+        os.path.normpath(os.path.join(cwd, input_template_path)))
     if output_path:
         output_dir = os.path.dirname(
-            os.path.abspath(output_path))
+            os.path.normpath(os.path.join(cwd, output_path)))
     else:
         output_dir = None
-    return template.render(spec_style=spec_style, epochs=epochs,
+    return template.stream(spec_style=spec_style, epochs=epochs,
                            requirements=requirements,
                            skip_pyversion=skip_pyversion,
                            input_template_dir=input_template_dir,
                            output_dir=output_dir)
 
 
+# input-template-format -> renderer
+_INPUT_TEMPLATE_FORMAT_RENDERERS = {
+    'spec.j2': _renderer_input_template_format_spec,
+}
+
+
 def _is_fedora(distname):
     """detect Fedora-based distro (e.g Fedora, CentOS, RHEL)"""
-    distname = distname.lower()
-    for x in ["fedora", "centos", "red hat"]:
-        if x in distname:
-            return True
-    return False
-
+    return bool(_FEDORA_RE.search(distname))
 
-def _get_default_distro():
 
-    distname = None
-    # Python 3.8 or newer does no longer provide this function
-    if hasattr(platform, 'linux_distribution'):
-        distname, _, _ = platform.linux_distribution()
+@functools.lru_cache(maxsize=1)
+def _os_release():
+    """get a dictionary with the key->value pairs from /etc/os-release"""
+    # newer distros only have /etc/os-release and platform.linux_distribution()
+    # is gone since Python 3.8: https://bugs.python.org/issue1322
+    try:
+        with open('/etc/os-release', 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    return {key: value.strip(_OS_RELEASE_STRIP_CHARS)
+            for key, sep, value in (line.partition('=') for line in lines)
+            if sep}
 
-    # newer distros only have /etc/os-release and then platform doesn't work
-    # anymore and upstream does not want to fix it:
-    # https://bugs.python.org/issue1322
-    if not distname and 'Linux' in platform.system():
-        try:
-            with open('/etc/os-release', 'r') as lsb_release:
-                for line in lsb_release:
-                    if line.startswith('ID_LIKE='):
-                        distname = line.partition('=')[2].strip(
-                            string.punctuation + string.whitespace)
-                        break
-            # Later Fedora versions (e.g. Fedora 32) do not include ID_LIKE
-            # in /etc/os-release, so we need to rely on ID
-            if not distname:
-                with open('/etc/os-release', 'r') as lsb_release:
-                    for line in lsb_release:
-                        if line.startswith('ID='):
-                            distname = line.partition('=')[2].strip(
-                                string.punctuation + string.whitespace)
-                            break
-        except OSError:
-            print('WARN: Unable to determine Linux distribution')
 
+def _get_default_distro():
+    os_release = _os_release()
+    # Later Fedora versions (e.g. Fedora 32) do not include ID_LIKE
+    # in /etc/os-release, so we need to rely on ID
+    distname = os_release.get('ID_LIKE') or os_release.get('ID')
     if not distname:
         print('WARN: Unable to determine Linux distribution')
+        return "unknown"
 
     if "suse" in distname.lower():
         return "suse"
@@ -121,18 +146,22 @@ def _get_default_distro():
 def _get_default_pyskips(distro):
     # py3 building is all complicated on CentOS 7.x
     if distro == 'fedora':
-        # Python 3.8 or newer does no longer provide this function
-        # CentOS 7 does not have Python 3.8
-        if hasattr(platform, 'linux_distribution'):
-            distname, distver, _ = platform.linux_distribution()
-            if 'CentOS' in distname and distver.startswith('7'):
-                return 'py3'
+        os_release = _os_release()
+        if (os_release.get('ID') == 'centos' and
+                os_release.get('VERSION_ID', '').startswith('7')):
+            return 'py3'
     return None
 
 
 def _get_default_template():
-    fns = [f for f in os.listdir('.')
-           if os.path.isfile(f) and f.endswith('.spec.j2')]
+    fns = []
+    with os.scandir('.') as it:
+        for entry in it:
+            if entry.name.endswith('.spec.j2') and entry.is_file():
+                fns.append(entry.name)
+                # more than one template is an error anyway
+                if len(fns) > 1:
+                    break
     if not fns:
         return None, ("No *.spec.j2 templates found. "
                       "See `renderspec -h` for usage.")
@@ -148,18 +177,38 @@ def _get_epochs(filename):
     """get a dictionary with pkg-name->epoch mapping"""
     epochs = {}
     if filename is not None:
+        # heavy imports are done lazily to keep e.g. --help fast
+        import yaml
+        try:
+            from yaml import CSafeLoader as _YamlLoader
+        except ImportError:
+            from yaml import SafeLoader as _YamlLoader
+
         with open(filename, 'r') as f:
-            data = yaml.safe_load(f.read())
+            # _YamlLoader is always one of the safe loaders
+            data = yaml.load(f, Loader=_YamlLoader)  # nosec
             epochs.update(data['epochs'])
     return epochs
 
 
+@functools.lru_cache(maxsize=32)
+def _parse_requirements_file(path, mtime_ns, size):
+    """get a (cached) dictionary with pkg-name->min-version mapping for the
+    given file. The mtime and size are part of the cache key so a changed
+    file is parsed again. The returned dict must not be modified"""
+    from renderspec import versions
+
+    with open(path, 'r') as f:
+        return versions.get_requirements(f.read().splitlines())
+
+
 def _get_requirements(filenames):
     """get a dictionary with pkg-name->min-version mapping"""
     reqs = {}
     for filename in filenames:
-        with open(filename, 'r') as f:
-            reqs.update(versions.get_requirements(f.readlines()))
+        st = os.stat(filename)
+        reqs.update(_parse_requirements_file(
+            os.path.abspath(filename), st.st_mtime_ns, st.st_size))
     return reqs
 
 
@@ -183,7 +232,8 @@ def process_args():
                         "default: *.spec.j2")
     parser.add_argument("-f", "--input-template-format", help="Format of the "
                         "input-template file. default: %(default)s",
-                        default="spec.j2", choices=["spec.j2"])
+                        default="spec.j2",
+                        choices=sorted(_INPUT_TEMPLATE_FORMAT_RENDERERS))
     parser.add_argument("--requirements", help="file(s) which contain "
                         "PEP0508 compatible requirement lines. Last mentioned "
                         "file has highest priority. default: %(default)s",
@@ -192,8 +242,25 @@ def process_args():
     return vars(parser.parse_args())
 
 
+def _process_args_fast(argv):
+    """handle the common 'renderspec foo.spec.j2' call without setting up
+    argparse. Returns None if argparse is needed.
+    Must return the same as process_args() would"""
+    if (len(argv) != 1 or argv[0].startswith('-') or
+            not argv[0].endswith('.spec.j2')):
+        return None
+    distro = _get_default_distro()
+    return {'output': None,
+            'spec_style': distro,
+            'skip_pyversion': _get_default_pyskips(distro),
+            'epochs': None,
+            'input-template': argv[0],
+            'input_template_format': 'spec.j2',
+            'requirements': []}
+
+
 def main():
-    args = process_args()
+    args = _process_args_fast(sys.argv[1:]) or process_args()
 
     # autodetect input/output fns if possible
     input_template = args['input-template']
@@ -222,16 +289,19 @@ def main():
     else:
         output_path = None
 
-    spec = generate_spec(args['spec_style'], epochs, requirements,
-                         args['skip_pyversion'],
-                         args['input_template_format'],
-                         input_template, output_path)
+    spec_args = (args['spec_style'], epochs, requirements,
+                 args['skip_pyversion'], args['input_template_format'],
+                 input_template, output_path)
     if output_path:
         print("Rendering: %s -> %s" % (input_template, output_path))
-        with open(output_path, "w") as o:
+        # render completely before opening the output file, so an existing
+        # spec is not truncated if rendering fails. Writing into the
+        # existing file keeps symlinks, hardlinks and the file metadata
+        spec = generate_spec(*spec_args)
+        with open(output_path, 'w', encoding='utf-8') as o:
             o.write(spec)
     else:
-        print(spec)
+        print(generate_spec(*spec_args))
     return 0
 
 
@@ -13,12 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import jinja2
 import os
+import re
 
 from jinja2.exceptions import TemplateRuntimeError
-from packaging.version import parse
-import pymod2pkg
 
 from renderspec import utils
 
@@ -37,14 +37,55 @@ CONTEXT_VAR_PYPI_NAME = "pypi_name"
 CONTEXT_VAR_UPSTREAM_VERSION = "upstream_version"
 CONTEXT_VAR_RPM_RELEASE = "rpm_release"
 
-
-def _context_check_variable(context, var_name, needed_by):
-    """check that the context has a given variable"""
-    if var_name not in context.vars:
+# marker for a variable which is not available in the context
+_MISSING = object()
+
+# python prerelease segment -> rpm version segment
+_PRERELEASE_TO_RPM = {
+    'a': '~xalpha',
+    'b': '~xbeta',
+    'rc': '~xrc',
+    '.dev': '~dev',
+}
+_PRERELEASE_RE = re.compile(r'rc|\.dev|a|b')
+
+# spdx license name -> fedora license name
+# more values can be taken from from https://github.com/hughsie/\
+#    appstream-glib/blob/master/libappstream-builder/asb-package-rpm.c#L76
+_SPDX_TO_FEDORA = {
+    "Apache-1.1": "ASL 1.1",
+    "Apache-2.0": "ASL 2.0",
+    "BSD-3-Clause": "BSD",
+    "GPL-1.0+": "GPL+",
+    "GPL-2.0": "GPLv2",
+    "GPL-2.0+": "GPLv2+",
+    "GPL-3.0": "GPLv3",
+    "GPL-3.0+": "GPLv3+",
+    "LGPL-2.1": "LGPLv2.1",
+    "LGPL-2.1+": "LGPLv2+",
+    "LGPL-2.0": "LGPLv2 with exceptions",
+    "LGPL-2.0+": "LGPLv2+ with exceptions",
+    "LGPL-3.0": "LGPLv3",
+    "LGPL-3.0+": "LGPLv3+",
+    "MIT": "MIT with advertising",
+    "MPL-1.0": "MPLv1.0",
+    "MPL-1.1": "MPLv1.1",
+    "MPL-2.0": "MPLv2.0",
+    "OFL-1.1": "OFL",
+    "Python-2.0": "Python",
+}
+
+
+def _context_get_variable(context, var_name, needed_by):
+    """get a variable from the context. Raise if it is not available"""
+    value = context.vars.get(var_name, _MISSING)
+    if value is _MISSING:
         raise TemplateRuntimeError("Variable '%s' not available in context but"
                                    " needed for '%s'" % (var_name, needed_by))
+    return value
 
 
+@contextfunction
 def _context_fetch_source(context, url):
     """fetch the given url into the output_dir and return the url"""
     if context['output_dir']:
@@ -53,21 +94,20 @@ def _context_fetch_source(context, url):
     return url
 
 
+@contextfunction
 def _context_url_pypi(context):
     """return the full sdist pypi url"""
     # we need the pypi_name and the upstream_version variables to construct
     # the full url
-    _context_check_variable(context, CONTEXT_VAR_PYPI_NAME,
-                            'pypi_name')
-
-    _context_check_variable(context, CONTEXT_VAR_UPSTREAM_VERSION,
-                            'upstream_version')
-    name = context.vars[CONTEXT_VAR_PYPI_NAME]
-    version = context.vars[CONTEXT_VAR_UPSTREAM_VERSION]
+    name = _context_get_variable(context, CONTEXT_VAR_PYPI_NAME,
+                                 'pypi_name')
+    version = _context_get_variable(context, CONTEXT_VAR_UPSTREAM_VERSION,
+                                    'upstream_version')
     return 'https://files.pythonhosted.org/packages/source/' \
         '%s/%s/%s-%s.tar.gz' % (name[0], name, name, version)
 
 
+@contextfunction
 def _context_upstream_version(context, pkg_version=None):
     """return the version which should be set to the 'upstream_version'
     variable in the jinja context"""
@@ -75,9 +115,8 @@ def _context_upstream_version(context, pkg_version=None):
         return pkg_version
     else:
         # try to auto-detect the version - for that we need the pypi name
-        _context_check_variable(context, CONTEXT_VAR_PYPI_NAME,
-                                'upstream_version')
-        pypi_name = context.vars[CONTEXT_VAR_PYPI_NAME]
+        pypi_name = _context_get_variable(context, CONTEXT_VAR_PYPI_NAME,
+                                          'upstream_version')
 
         # look for archives in:
         # 1) the output_dir
@@ -87,24 +126,32 @@ def _context_upstream_version(context, pkg_version=None):
                                          context['input_template_dir'],
                                          '.'], pypi_name)
         for archive in archives:
-            with utils._extract_archive_to_tempdir(archive) as tmpdir:
-                pkg_info_file = utils._find_pkg_info(tmpdir)
-                if pkg_info_file:
-                    return utils._get_version_from_pkg_info(pkg_info_file)
+            version = utils._get_version_from_archive(archive)
+            if version:
+                return version
         # unable to autodetect the version
         raise TemplateRuntimeError("Can not autodetect 'upstream_version' from"
                                    " the following archives: '%s'" % (
                                        ', '.join(archives)))
 
 
+@functools.lru_cache(maxsize=256)
+def _parse_version(version):
+    """cached packaging.version.parse()"""
+    # packaging is imported on first use
+    from packaging.version import parse
+
+    return parse(version)
+
+
+@contextfunction
 def _context_py2rpmversion(context):
     """get a python PEP0440 compatible version and translate it to an RPM
     version"""
     # the context needs a variable set via {% set upstream_version = 'ver' %}
-    _context_check_variable(context, CONTEXT_VAR_UPSTREAM_VERSION,
-                            'py2rpmversion')
-    version = context.vars[CONTEXT_VAR_UPSTREAM_VERSION]
-    v_python = parse(version)
+    version = _context_get_variable(context, CONTEXT_VAR_UPSTREAM_VERSION,
+                                    'py2rpmversion')
+    v_python = _parse_version(version)
     # fedora does not allow '~' in versions but uses a combination of Version
     # and Release
     # https://fedoraproject.org/wiki/Packaging:Versioning\#Pre-Release_packages
@@ -119,24 +166,21 @@ def _context_py2rpmversion(context):
             # we need to add the 'x' in front of alpha/beta releases because
             # in the python world, "1.1a10" > "1.1.dev10"
             # but in the rpm world, "1.1~a10" < "1.1~dev10"
-            v_rpm = v_rpm.replace('a', '~xalpha')
-            v_rpm = v_rpm.replace('b', '~xbeta')
-            v_rpm = v_rpm.replace('rc', '~xrc')
-            v_rpm = v_rpm.replace('.dev', '~dev')
+            v_rpm = _PRERELEASE_RE.sub(
+                lambda m: _PRERELEASE_TO_RPM[m.group(0)], v_rpm)
         return v_rpm
 
 
+@contextfunction
 def _context_py2rpmrelease(context):
     if context['spec_style'] == 'fedora':
         # the context needs a var set via {% set upstream_version = 'ver' %}
-        _context_check_variable(context, CONTEXT_VAR_UPSTREAM_VERSION,
-                                'py2rpmrelease')
+        upstream_version = _context_get_variable(
+            context, CONTEXT_VAR_UPSTREAM_VERSION, 'py2rpmrelease')
         # the context needs a var set via {% set rpm_release = 'ver' %}
-        _context_check_variable(context, CONTEXT_VAR_RPM_RELEASE,
-                                'py2rpmrelease')
-        upstream_version = context.vars[CONTEXT_VAR_UPSTREAM_VERSION]
-        rpm_release = context.vars[CONTEXT_VAR_RPM_RELEASE]
-        v_python = parse(upstream_version)
+        rpm_release = _context_get_variable(
+            context, CONTEXT_VAR_RPM_RELEASE, 'py2rpmrelease')
+        v_python = _parse_version(upstream_version)
         if v_python.is_prerelease:
             _, alphatag = v_python.public.split(v_python.base_version)
             return '0.{}.{}%{{?dist}}'.format(rpm_release,
@@ -148,26 +192,46 @@ def _context_py2rpmrelease(context):
         return '0'
 
 
-def _context_epoch(context, pkg_name):
+# NOTE: used as filter and as global. jinja2 < 3 has separate contextfilter
+# and contextfunction markers so both are needed. With jinja2 >= 3 both are
+# pass_context and applying it twice does no harm.
+# The parameter is called 'value' because templates might use epoch(value=)
+@contextfilter
+@contextfunction
+def _context_epoch(context, value):
     """get the epoch (or 0 if unknown) for the given pkg name"""
-    return context['epochs'].get(pkg_name, 0)
+    return context['epochs'].get(value, 0)
 
 
-def _pymod2pkg_translate(pkg_name, context, py_versions):
-    """translate a given package name for a single or multiple py versions"""
-    if py_versions and not isinstance(py_versions, (list, tuple)):
-        py_versions = [py_versions]
+@functools.lru_cache(maxsize=2048)
+def _pymod2pkg_translate_cached(pkg_name, spec_style, py_versions,
+                                skip_pyversion):
+    """the cached part of _pymod2pkg_translate(). All parameters must be
+    hashable. Returns a tuple"""
+    import pymod2pkg
+
     kwargs = {}
     if py_versions:
-        kwargs['py_vers'] = [i for i in py_versions if i not in
-                             set((context['skip_pyversion'],))]
+        kwargs['py_vers'] = [i for i in py_versions if i != skip_pyversion]
 
-    translations = pymod2pkg.module2package(
-        pkg_name, context['spec_style'], **kwargs)
+    translations = pymod2pkg.module2package(pkg_name, spec_style, **kwargs)
     # we want always return a list but module2package() might return a string
     if not isinstance(translations, (list, tuple)):
         translations = [translations]
-    return translations
+    # the result is shared between callers so don't hand out a mutable list
+    return tuple(translations)
+
+
+def _pymod2pkg_translate(pkg_name, context, py_versions):
+    """translate a given package name for a single or multiple py versions"""
+    if not py_versions:
+        return _pymod2pkg_translate_cached(
+            pkg_name, context['spec_style'], None, None)
+    if not isinstance(py_versions, (list, tuple)):
+        py_versions = [py_versions]
+    return _pymod2pkg_translate_cached(
+        pkg_name, context['spec_style'], tuple(py_versions),
+        context['skip_pyversion'])
 
 
 def _context_py2name(context, pkg_name=None, pkg_version=None,
@@ -182,145 +246,67 @@ def _context_py2name(context, pkg_name=None, pkg_version=None,
     """
     if not pkg_name:
         # if the name is not given, try to get the name from the context
-        _context_check_variable(context, CONTEXT_VAR_PYPI_NAME,
-                                'py2name')
-        pkg_name = context.vars[CONTEXT_VAR_PYPI_NAME]
+        pkg_name = _context_get_variable(context, CONTEXT_VAR_PYPI_NAME,
+                                         'py2name')
     # return always a string to be backwards compat
     return ' '.join(_pymod2pkg_translate(pkg_name, context, py_versions))
 
 
+@contextfunction
 def _context_py2pkg(context, pkg_name, pkg_version=None, py_versions=None):
     """generate a distro specific package name with optional version tuple."""
     name_list = _pymod2pkg_translate(pkg_name, context, py_versions)
 
     # if no pkg_version is given, look in the requirements and set one
+    # NOTE: a lookup in a jinja2 context is not a plain dict lookup, so the
+    # context values are only looked up once
     if not pkg_version:
-        if pkg_name in context['requirements']:
-            pkg_version = ('>=', context['requirements'][pkg_name])
+        version = context['requirements'].get(pkg_name, _MISSING)
+        if version is not _MISSING:
+            pkg_version = ('>=', version)
 
     # pkg_version is a tuple with comparator and number, i.e. "('>=', '1.2.3')"
     if pkg_version:
         # epoch handling
-        if pkg_name in context['epochs'].keys():
-            epoch = '%s:' % context['epochs'][pkg_name]
+        epoch = context['epochs'].get(pkg_name, _MISSING)
+        if epoch is not _MISSING:
+            epoch = f'{epoch}:'
         else:
             epoch = ''
         v_comparator, v_number = pkg_version
-        v_str = ' %s %s%s' % (v_comparator, epoch, v_number)
+        v_str = f' {v_comparator} {epoch}{v_number}'
     else:
         v_str = ''
 
-    return ' '.join(['%s%s' % (name, v_str) for name in name_list])
+    return ' '.join([f'{name}{v_str}' for name in name_list])
 
 
+@contextfunction
 def _context_py2(context, pkg_name, pkg_version=None):
     return _context_py2pkg(context, pkg_name, pkg_version, py_versions=['py2'])
 
 
+@contextfunction
 def _context_py3(context, pkg_name, pkg_version=None):
     return _context_py2pkg(context, pkg_name, pkg_version, py_versions=['py3'])
 
 
+@contextfunction
 def _context_license_spdx(context, value):
     """convert a given known spdx license to another one"""
-    # more values can be taken from from https://github.com/hughsie/\
-    #    appstream-glib/blob/master/libappstream-builder/asb-package-rpm.c#L76
-    mapping = {
-        "Apache-1.1": "ASL 1.1",
-        "Apache-2.0": "ASL 2.0",
-        "BSD-3-Clause": "BSD",
-        "GPL-1.0+": "GPL+",
-        "GPL-2.0": "GPLv2",
-        "GPL-2.0+": "GPLv2+",
-        "GPL-3.0": "GPLv3",
-        "GPL-3.0+": "GPLv3+",
-        "LGPL-2.1": "LGPLv2.1",
-        "LGPL-2.1+": "LGPLv2+",
-        "LGPL-2.0": "LGPLv2 with exceptions",
-        "LGPL-2.0+": "LGPLv2+ with exceptions",
-        "LGPL-3.0": "LGPLv3",
-        "LGPL-3.0+": "LGPLv3+",
-        "MIT": "MIT with advertising",
-        "MPL-1.0": "MPLv1.0",
-        "MPL-1.1": "MPLv1.1",
-        "MPL-2.0": "MPLv2.0",
-        "OFL-1.1": "OFL",
-        "Python-2.0": "Python",
-    }
-
     if context['spec_style'] == 'fedora':
-        return mapping[value]
+        return _SPDX_TO_FEDORA[value]
 
     # just use the spdx license name
     return value
 
 
-###############
-# jinja2 filter
-###############
-@contextfilter
-def _filter_epoch(context, value):
-    return _context_epoch(context, value)
-
-
-@contextfilter
-def _filter_basename(context, value):
-    return os.path.basename(value)
-
-
 ################
 # jinja2 globals
 ################
-@contextfunction
-def _globals_py2pkg(context, pkg_name, pkg_version=None, py_versions=None):
-    return _context_py2pkg(context, pkg_name, pkg_version, py_versions)
-
-
-@contextfunction
-def _globals_py2(context, pkg_name, pkg_version=None):
-    return _context_py2(context, pkg_name, pkg_version)
-
-
-@contextfunction
-def _globals_py3(context, pkg_name, pkg_version=None):
-    return _context_py3(context, pkg_name, pkg_version)
-
-
-@contextfunction
-def _globals_fetch_source(context, url):
-    return _context_fetch_source(context, url)
-
-
-@contextfunction
-def _globals_url_pypi(context):
-    return _context_url_pypi(context)
-
-
-@contextfunction
-def _globals_upstream_version(context, pkg_version=None):
-    return _context_upstream_version(context, pkg_version)
-
-
-@contextfunction
-def _globals_py2rpmversion(context):
-    return _context_py2rpmversion(context)
-
-
-@contextfunction
-def _globals_py2rpmrelease(context):
-    return _context_py2rpmrelease(context)
-
-
-@contextfunction
-def _globals_epoch(context, value):
-    return _context_epoch(context, value)
-
-
-@contextfunction
-def _globals_license_spdx(context, value):
-    return _context_license_spdx(context, value)
-
-
+# NOTE: the other context functions are registered directly. py2name() has
+# py_versions as second parameter (_context_py2name() has the deprecated
+# pkg_version there) so it needs a wrapper
 @contextfunction
 def _globals_py2name(context, value=None, py_versions=None):
     return _context_py2name(context, value, py_versions=py_versions)
@@ -328,16 +314,16 @@ def _globals_py2name(context, value=None, py_versions=None):
 
 def env_register_filters_and_globals(env):
     """register all the jinja2 filters we want in the environment"""
-    env.filters['epoch'] = _filter_epoch
-    env.filters['basename'] = _filter_basename
-    env.globals['py2rpmversion'] = _globals_py2rpmversion
-    env.globals['py2rpmrelease'] = _globals_py2rpmrelease
-    env.globals['py2pkg'] = _globals_py2pkg
-    env.globals['py2'] = _globals_py2
-    env.globals['py3'] = _globals_py3
+    env.filters['epoch'] = _context_epoch
+    env.filters['basename'] = os.path.basename
+    env.globals['py2rpmversion'] = _context_py2rpmversion
+    env.globals['py2rpmrelease'] = _context_py2rpmrelease
+    env.globals['py2pkg'] = _context_py2pkg
+    env.globals['py2'] = _context_py2
+    env.globals['py3'] = _context_py3
     env.globals['py2name'] = _globals_py2name
-    env.globals['epoch'] = _globals_epoch
-    env.globals['license'] = _globals_license_spdx
-    env.globals['upstream_version'] = _globals_upstream_version
-    env.globals['fetch_source'] = _globals_fetch_source
-    env.globals['url_pypi'] = _globals_url_pypi
+    env.globals['epoch'] = _context_epoch
+    env.globals['license'] = _context_license_spdx
+    env.globals['upstream_version'] = _context_upstream_version
+    env.globals['fetch_source'] = _context_fetch_source
+    env.globals['url_pypi'] = _context_url_pypi
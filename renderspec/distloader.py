@@ -49,12 +49,16 @@ class RenderspecLoader(jinja2.BaseLoader):
 
         f = open_if_exists(fn)
         if not f:
-            return TemplateNotFound(template)
+            raise TemplateNotFound(template)
         try:
             contents = f.read().decode(self.encoding)
         finally:
             f.close()
 
+        if not environment.auto_reload:
+            # uptodate() is never called so there is no need to stat the file
+            return contents, fn, None
+
         mtime = os.path.getmtime(self.base_fn)
 
         def uptodate():
@@ -67,10 +71,12 @@ class RenderspecLoader(jinja2.BaseLoader):
 
     def list_templates(self):
         found = set([self.base_ref])
-        walk_dir = os.walk(self.disttemp_path)
-        for _, _, filenames in walk_dir:
-            for fn in filenames:
-                if fn.endswith(self.template_postfix):
-                    template = fn[:-len(self.template_postfix)]
-                    found.add(template)
+        # get_source() only looks directly in disttemp_path so there is no
+        # need to walk into subdirectories
+        postfix = self.template_postfix
+        postfix_len = len(postfix)
+        with os.scandir(self.disttemp_path) as it:
+            for entry in it:
+                if entry.name.endswith(postfix) and entry.is_file():
+                    found.add(entry.name[:-postfix_len])
         return sorted(found)
@@ -15,15 +15,21 @@
 # limitations under the License.
 
 from contextlib import closing
-from contextlib import contextmanager
-from email.parser import HeaderParser
 import os
+import re
 import shutil
 import tarfile
-import tempfile
 import urllib.request
 import zipfile
 
+# archive file names end with one of these extensions
+_ARCHIVE_RE = re.compile(r'(?:tar\.gz|zip|tar\.bz2|xz)$')
+
+# the Version header line of a PKG-INFO file (see pep-0314). The version
+# must be on the same line (an empty Version header has no version)
+_PKG_INFO_VERSION_RE = re.compile(rb'^Version:[ \t]*(\S.*?)[ \t\r]*$',
+                                  re.MULTILINE)
+
 
 def _download_file(url, dest_dir, dest_filename):
     """download a given url to a given destination directory and
@@ -31,34 +37,54 @@ def _download_file(url, dest_dir, dest_filename):
     filename = os.path.join(dest_dir, dest_filename)
     with closing(urllib.request.urlopen(url)) as response:  # nosec
         with open(filename, 'wb') as f:
-            while True:
-                buf = response.read(8192)
-                if not buf:
-                    break
-                f.write(buf)
+            shutil.copyfileobj(response, f, length=1024 * 1024)
+
 
+def _find_pkg_info_member(names):
+    """return the archive member name of the PKG-INFO file which is closest
+    to the archive root or None if not found"""
+    pkg_infos = [n for n in names if n.rsplit('/', 1)[-1] == 'PKG-INFO']
+    return min(pkg_infos, key=lambda n: n.count('/'), default=None)
 
-@contextmanager
-def _extract_archive_to_tempdir(archive_filename):
-    """extract the given tarball or zipfile to a tempdir.
-    Delete the tempdir at the end"""
+
+def _get_version_from_archive(archive_filename):
+    """get the version from the PKG-INFO file in the given tarball or zipfile
+    without extracting the archive. Return None if there is no PKG-INFO"""
     if not os.path.exists(archive_filename):
         raise Exception("Archive '%s' does not exist" % (archive_filename))
 
-    tempdir = tempfile.mkdtemp(prefix="renderspec_")
+    data = None
     try:
-        if tarfile.is_tarfile(archive_filename):
-            with tarfile.open(archive_filename) as f:
-                f.extractall(tempdir)
-        elif zipfile.is_zipfile(archive_filename):
-            with zipfile.ZipFile(archive_filename) as f:
-                f.extractall(tempdir)
-        else:
-            raise Exception("Can not extract '%s'. "
+        # read the tarball as a stream and stop as soon as the top-level
+        # PKG-INFO (usually '<name>-<version>/PKG-INFO') was found
+        with tarfile.open(archive_filename, mode='r|*') as f:
+            depth = None
+            for member in f:
+                if (member.isfile() and
+                        member.name.rsplit('/', 1)[-1] == 'PKG-INFO'):
+                    member_depth = member.name.count('/')
+                    if depth is None or member_depth < depth:
+                        depth = member_depth
+                        data = f.extractfile(member).read()
+                        if depth <= 1:
+                            break
+    except tarfile.ReadError:
+        if not zipfile.is_zipfile(archive_filename):
+            raise Exception("Can not read '%s'. "
                             "Not a tar or zip file" % archive_filename)
-        yield tempdir
-    finally:
-        shutil.rmtree(tempdir)
+        with zipfile.ZipFile(archive_filename) as f:
+            member = _find_pkg_info_member(f.namelist())
+            if member:
+                data = f.read(member)
+
+    if data:
+        # only search the headers. They end with the first empty line and
+        # the (long) description follows
+        headers = data.split(b'\n\n', 1)[0]
+        match = _PKG_INFO_VERSION_RE.search(headers)
+        if match:
+            return match.group(1).decode('utf-8')
+    return None
 
 
 def _find_archives(directories, basename):
@@ -67,26 +93,22 @@ def _find_archives(directories, basename):
     if isinstance(directories, str):
         directories = [directories]
 
-    return sorted(
-        [os.path.join(d, f) for d in directories if d for f in os.listdir(d)
-         if f.startswith(basename) and
-         f.endswith(('tar.gz', 'zip', 'tar.bz2', 'xz'))],
-        key=lambda x: os.stat(x).st_mtime, reverse=True)
-
-
-def _find_pkg_info(directory):
-    """find and return the full path to a PKG-INFO file or None if not found"""
-    for root, dirs, files in os.walk(directory):
-        for filename in files:
-            if filename == 'PKG-INFO':
-                return os.path.join(root, filename)
-    # no PKG-INFO file found
-    return None
-
+    # the same directory might be given multiple times (e.g. the output dir
+    # is also the current working dir) but should only be scanned once
+    unique_dirs = {}
+    for d in directories:
+        if d:
+            unique_dirs.setdefault(os.path.abspath(d), d)
 
-def _get_version_from_pkg_info(pkg_info_filename):
-    """get the version from a PKG-INFO (see pep-0314) file"""
-    with open(pkg_info_filename, 'r') as f:
-        parser = HeaderParser()
-        headers = parser.parse(f)
-        return headers.get('version')
+    # (mtime, path) tuples. DirEntry.stat() can reuse the data from scandir
+    archives = []
+    for d in unique_dirs.values():
+        with os.scandir(d) as it:
+            for entry in it:
+                if (entry.name.startswith(basename) and
+                        _ARCHIVE_RE.search(entry.name) and entry.is_file()):
+                    archives.append((entry.stat().st_mtime,
+                                     os.path.join(d, entry.name)))
+    # latest archive first
+    archives.sort(key=lambda x: x[0], reverse=True)
+    return [path for _, path in archives]
@@ -14,40 +14,85 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import re
+import sys
+
+from packaging.markers import Marker
 from packaging.requirements import Requirement
 from packaging.version import Version
 
+# TODO (toabctl): currently we hardcode python 2.7 and linux2
+# see https://www.python.org/dev/peps/pep-0508/#environment-markers
+_MARKER_ENV = {'python_version': '2.7', 'sys_platform': 'linux'}
+
+# plain, already normalized release versions (e.g. "1.16.0") which don't
+# need a PEP0440 parser
+_RELEASE_RE = re.compile(r'\A(?:0|[1-9]\d*)(?:\.(?:0|[1-9]\d*))*\Z')
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_requirement(line):
+    """cached packaging.requirements.Requirement(line). The same lines
+    usually appear multiple times (e.g. in multiple requirement files)"""
+    return Requirement(line)
+
+
+@functools.lru_cache(maxsize=2048)
+def _version(version):
+    """cached packaging.version.Version(version). Comparing cached Version
+    objects reuses their already computed comparison keys"""
+    return Version(version)
+
+
+def _release_key(release):
+    """comparison key for a plain release version. Trailing zeros are
+    dropped because "1.0" == "1.0.0" (as for packaging's Version)"""
+    key = [int(i) for i in release.split('.')]
+    while key and key[-1] == 0:
+        key.pop()
+    return tuple(key)
+
+
+def _lowest_version(versions):
+    """get the lowest of the given versions as normalized string.
+    Returns None if there are no versions"""
+    versions = list(versions)
+    if not versions:
+        return None
+    if all(_RELEASE_RE.match(v) for v in versions):
+        # already normalized so the original string can be used
+        return min(versions, key=_release_key)
+    return str(_version(min(versions, key=_version)))
+
+
+@functools.lru_cache(maxsize=1024)
+def _marker_matches(marker):
+    """check if the given marker (as string) matches our environment"""
+    return Marker(marker).evaluate(environment=_MARKER_ENV)
+
 
 def get_requirements(lines):
     """parse the given lines and return a dict with pkg_name->version.
     lines must follow PEP0508"""
     requires = {}
     for line in lines:
-        # skip comments and empty lines
-        if line.startswith('#') or len(line.strip()) == 0:
+        # remove comments. comment-only and empty lines are skipped
+        line = line.partition('#')[0].strip()
+        if not line:
             continue
-        # remove trailing comments
-        line = line.split('#')[0].rstrip(' ')
-        r = Requirement(line)
+        r = _parse_requirement(line)
         # check if we need the requirement
-        if r.marker:
-            # TODO (toabctl): currently we hardcode python 2.7 and linux2
-            # see https://www.python.org/dev/peps/pep-0508/#environment-markers
-            marker_env = {'python_version': '2.7', 'sys_platform': 'linux'}
-            if not r.marker.evaluate(environment=marker_env):
-                continue
+        if r.marker and not _marker_matches(str(r.marker)):
+            continue
         if r.specifier:
             # we want the lowest possible version
             # NOTE(toabctl): "min(r.specifier)" doesn't work.
             # see https://github.com/pypa/packaging/issues/69
-            lowest = None
-            for s in r.specifier:
-                # we don't want a lowest version which is not allowed
-                if s.operator == '!=':
-                    continue
-                if not lowest or Version(s.version) < lowest:
-                    lowest = Version(s.version)
-
-            if lowest:
-                requires[r.name] = str(lowest)
+            # we don't want a lowest version which is not allowed
+            lowest = _lowest_version(s.version for s in r.specifier
+                                     if s.operator != '!=')
+            if lowest is not None:
+                # the names are used for many lookups while rendering
+                requires[sys.intern(r.name)] = lowest
     return requires
@@ -20,138 +20,138 @@ import unittest
 from ddt import data, ddt, unpack
 
 from jinja2 import Environment
+from jinja2.exceptions import TemplateNotFound
 from jinja2.exceptions import TemplateRuntimeError
 
-from unittest.mock import Mock, patch
+from pathlib import Path
+from unittest.mock import mock_open, patch
 import os
 import renderspec
 import renderspec.contextfuncs
+import renderspec.distloader
 import renderspec.utils
 import renderspec.versions
 import shutil
 import tempfile
-import time
+
+
+def _ctx(**kwargs):
+    """a context for the context function tests with the default values"""
+    context = {'spec_style': 'suse', 'skip_pyversion': (), 'epochs': {},
+               'requirements': {}}
+    context.update(kwargs)
+    return context
+
+
+# (context, pkg_name, pkg_version, py_versions, expected_result) for
+# test_context_py2pkg
+_PY2PKG_CASES = (
+    # without version
+    (_ctx(), 'oslo.config', None, None, 'python-oslo.config'),
+    (_ctx(spec_style='fedora'),
+     'oslo.config', None, None, 'python-oslo-config'),
+    # without version, multiple python versions
+    (_ctx(), 'oslo.config', None, ('py', 'py3'),
+     'python-oslo.config python3-oslo.config'),
+    # with version
+    (_ctx(), 'oslo.config', ('>=', '1.2.3'), None,
+     'python-oslo.config >= 1.2.3'),
+    (_ctx(spec_style='fedora'),
+     'oslo.config', ('==', '1.2.3~a0'), None,
+     'python-oslo-config == 1.2.3~a0'),
+    # with version, with epoch
+    (_ctx(epochs={'oslo.config': 4}),
+     'oslo.config', ('>=', '1.2.3'), None,
+     'python-oslo.config >= 4:1.2.3'),
+    # without version, with epoch
+    (_ctx(epochs={'oslo.config': 4}),
+     'oslo.config', None, None, 'python-oslo.config'),
+    # with version, with requirements
+    (_ctx(requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), None, 'python-oslo.config >= 4.5.6'),
+    # without version, with requirements
+    (_ctx(requirements={'oslo.config': '1.2.3'}),
+     'oslo.config', None, None, 'python-oslo.config >= 1.2.3'),
+    # without version, with requirements, with epoch
+    (_ctx(epochs={'oslo.config': 4},
+          requirements={'oslo.config': '1.2.3'}),
+     'oslo.config', None, None, 'python-oslo.config >= 4:1.2.3'),
+    # with version, with requirements, with epoch
+    (_ctx(epochs={'oslo.config': 4},
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), None,
+     'python-oslo.config >= 4:4.5.6'),
+    # with version, with requirements, with epoch, python2
+    (_ctx(epochs={'oslo.config': 4},
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), 'py2',
+     'python2-oslo.config >= 4:4.5.6'),
+    # with version, with requirements, with epoch, python3
+    (_ctx(epochs={'oslo.config': 4},
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), 'py3',
+     'python3-oslo.config >= 4:4.5.6'),
+    # with version, with requirements, python3, skip python3
+    (_ctx(skip_pyversion='py3',
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), 'py3',
+     ''),
+    # with version, with requirements, with epoch, python2 and python3
+    (_ctx(epochs={'oslo.config': 4},
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), ['py2', 'py3'],
+     'python2-oslo.config >= 4:4.5.6 python3-oslo.config >= 4:4.5.6'),
+    # with version, with requirements, python2 and python3, skip python3
+    (_ctx(epochs={'oslo.config': 4}, skip_pyversion='py3',
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), ['py2', 'py3'],
+     'python2-oslo.config >= 4:4.5.6'),
+    # with version, with requirements, python2 and python3, skip python2
+    (_ctx(epochs={'oslo.config': 4}, skip_pyversion='py2',
+          requirements={'oslo.config' '1.2.3'}),
+     'oslo.config', ('>=', '4.5.6'), ['py2', 'py3'],
+     'python3-oslo.config >= 4:4.5.6'),
+)
 
 
 @ddt
 class RenderspecContextFunctionTests(unittest.TestCase):
     """test functions which do some calculation based on the context"""
     def test_context_license_spdx(self):
-        self.assertEqual(
-            renderspec.contextfuncs._context_license_spdx(
-                {'spec_style': 'suse'}, 'Apache-2.0'),
-            'Apache-2.0'
-        )
-        self.assertEqual(
-            renderspec.contextfuncs._context_license_spdx(
-                {'spec_style': 'fedora'}, 'Apache-2.0'),
-            'ASL 2.0'
-        )
-
-    @data(
-        # without version
-        ({'spec_style': 'suse', 'epochs': {}, 'requirements': {}},
-         'oslo.config', None, None, 'python-oslo.config'),
-        ({'spec_style': 'fedora', 'epochs': {}, 'requirements': {}},
-         'oslo.config', None, None, 'python-oslo-config'),
-        # without version, multiple python versions
-        ({'spec_style': 'suse', 'epochs': {}, 'requirements': {}},
-         'oslo.config', None, ('py', 'py3'),
-         'python-oslo.config python3-oslo.config'),
-        # with version
-        ({'epochs': {}, 'requirements': {}},
-         'oslo.config', ('>=', '1.2.3'), None, 'python-oslo.config >= 1.2.3'),
-        ({'spec_style': 'fedora', 'epochs': {}, 'requirements': {}},
-         'oslo.config', ('==', '1.2.3~a0'), None,
-         'python-oslo-config == 1.2.3~a0'),
-        # with version, with epoch
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {}},
-         'oslo.config', ('>=', '1.2.3'), None,
-         'python-oslo.config >= 4:1.2.3'),
-        # without version, with epoch
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {}},
-         'oslo.config', None, None, 'python-oslo.config'),
-        # with version, with requirements
-        ({'epochs': {},
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), None, 'python-oslo.config >= 4.5.6'),
-        # without version, with requirements
-        ({'epochs': {},
-          'requirements': {'oslo.config': '1.2.3'}},
-         'oslo.config', None, None, 'python-oslo.config >= 1.2.3'),
-        # without version, with requirements, with epoch
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {'oslo.config': '1.2.3'}},
-         'oslo.config', None, None, 'python-oslo.config >= 4:1.2.3'),
-        # with version, with requirements, with epoch
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), None,
-         'python-oslo.config >= 4:4.5.6'),
-        # with version, with requirements, with epoch, python2
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), 'py2',
-         'python2-oslo.config >= 4:4.5.6'),
-        # with version, with requirements, with epoch, python3
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), 'py3',
-         'python3-oslo.config >= 4:4.5.6'),
-        # with version, with requirements, python3, skip python3
-        ({'epochs': {}, 'skip_pyversion': 'py3',
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), 'py3',
-         ''),
-        # with version, with requirements, with epoch, python2 and python3
-        ({'epochs': {'oslo.config': 4},
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), ['py2', 'py3'],
-         'python2-oslo.config >= 4:4.5.6 python3-oslo.config >= 4:4.5.6'),
-        # with version, with requirements, python2 and python3, skip python3
-        ({'epochs': {'oslo.config': 4}, 'skip_pyversion': 'py3',
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), ['py2', 'py3'],
-         'python2-oslo.config >= 4:4.5.6'),
-        # with version, with requirements, python2 and python3, skip python2
-        ({'epochs': {'oslo.config': 4}, 'skip_pyversion': 'py2',
-          'requirements': {'oslo.config' '1.2.3'}},
-         'oslo.config', ('>=', '4.5.6'), ['py2', 'py3'],
-         'python3-oslo.config >= 4:4.5.6'),
-    )
+        for style, spdx, expected in (('suse', 'Apache-2.0', 'Apache-2.0'),
+                                      ('fedora', 'Apache-2.0', 'ASL 2.0')):
+            with self.subTest(style=style, spdx=spdx):
+                self.assertEqual(
+                    renderspec.contextfuncs._context_license_spdx(
+                        {'spec_style': style}, spdx),
+                    expected)
+
+    @data(*_PY2PKG_CASES)
     @unpack
     def test_context_py2pkg(self, context, pkg_name, pkg_version,
                             py_versions, expected_result):
-        context.setdefault('skip_pyversion', ())
-        context.setdefault('spec_style', 'suse')
         self.assertEqual(
             renderspec.contextfuncs._context_py2pkg(
                 context, pkg_name, pkg_version, py_versions),
             expected_result)
 
     @data(
-        ({'spec_style': 'suse', 'epochs': {}, 'requirements': {}},
-         'oslo.config', None, 'python2-oslo.config'),
+        (_ctx(), 'oslo.config', None, 'python2-oslo.config'),
     )
     @unpack
     def test_context_py2(self, context, pkg_name, pkg_version,
                          expected_result):
-        context.setdefault('skip_pyversion', ())
         self.assertEqual(
             renderspec.contextfuncs._context_py2(
                 context, pkg_name, pkg_version),
             expected_result)
 
     @data(
-        ({'spec_style': 'suse', 'epochs': {}, 'requirements': {}},
-         'oslo.config', None, 'python3-oslo.config'),
+        (_ctx(), 'oslo.config', None, 'python3-oslo.config'),
     )
     @unpack
     def test_context_py3(self, context, pkg_name, pkg_version,
                          expected_result):
-        context.setdefault('skip_pyversion', ())
         self.assertEqual(
             renderspec.contextfuncs._context_py3(
                 context, pkg_name, pkg_version),
@@ -182,36 +182,47 @@ class RenderspecContextFunctionTests(unittest.TestCase):
         ('.', 1)
     )
     @unpack
+    @patch('renderspec.utils._download_file')
     def test_context_fetch_source_no_output_dir(self, output_dir,
-                                                expected_calls):
+                                                expected_calls, m):
         context = {'spec_style': 'suse', 'epochs': {},
                    'requirements': {}, 'output_dir': output_dir}
         url = 'http://foo/bar'
-        with patch('renderspec.utils._download_file') as m:
-            self.assertEqual(renderspec.contextfuncs._context_fetch_source(
-                context, url), url)
-            self.assertEqual(m.call_count, expected_calls)
+        self.assertEqual(renderspec.contextfuncs._context_fetch_source(
+            context, url), url)
+        self.assertEqual(m.call_count, expected_calls)
 
 
 @ddt
 class RenderspecTemplateFunctionTests(unittest.TestCase):
-    def setUp(self):
-        """create a Jinja2 environment and register the standard filters"""
-        self.env = Environment()
-        renderspec.contextfuncs.env_register_filters_and_globals(self.env)
+    @classmethod
+    def setUpClass(cls):
+        """create a Jinja2 environment and register the standard filters.
+        The tests don't modify the environment so it is shared"""
+        cls.env = Environment()
+        renderspec.contextfuncs.env_register_filters_and_globals(cls.env)
+        cls._templates = {}
+
+    def _from_string(self, source):
+        """compile the given template source only once (a lot of the
+        test data uses the same templates)"""
+        template = self._templates.get(source)
+        if template is None:
+            template = self._templates[source] = self.env.from_string(source)
+        return template
 
     @data(
         ("{{ 'http://foo/bar'|basename }}", "bar")
     )
     @unpack
     def test_render_func_basename(self, input, expected):
-        template = self.env.from_string(input)
+        template = self._from_string(input)
         self.assertEqual(
             template.render(spec_style='suse', epochs={}, requirements={}),
             expected)
 
     def test_render_func_license_spdx(self):
-        template = self.env.from_string(
+        template = self._from_string(
             "{{ license('Apache-2.0') }}")
         self.assertEqual(
             template.render(spec_style='fedora', epochs={}, requirements={}),
@@ -219,60 +230,60 @@ class RenderspecTemplateFunctionTests(unittest.TestCase):
 
     @data(
         # plain
-        ({'epochs': {}, 'requirements': {}},
-         "{{ py2pkg('requests') }}", "python-requests"),
+        (_ctx(), "{{ py2pkg('requests') }}", "python-requests"),
         # plain, with multiple py_versions
-        ({'epochs': {}, 'requirements': {}},
-         "{{ py2pkg('requests', py_versions=['py2', 'py3']) }}",
+        (_ctx(), "{{ py2pkg('requests', py_versions=['py2', 'py3']) }}",
          "python2-requests python3-requests"),
         # with version
-        ({'epochs': {}, 'requirements': {}},
-         "{{ py2pkg('requests', ('>=', '2.8.1')) }}",
+        (_ctx(), "{{ py2pkg('requests', ('>=', '2.8.1')) }}",
          "python-requests >= 2.8.1"),
         # with version, with epoch
-        ({'epochs': {'requests': 4}, 'requirements': {}},
+        (_ctx(epochs={'requests': 4}),
          "{{ py2pkg('requests', ('>=', '2.8.1')) }}",
          "python-requests >= 4:2.8.1"),
         # with version, with epoch, with requirements
-        ({'epochs': {'requests': 4},
-          'requirements': {'requests': '1.2.3'}},
+        (_ctx(epochs={'requests': 4}, requirements={'requests': '1.2.3'}),
          "{{ py2pkg('requests', ('>=', '2.8.1')) }}",
          "python-requests >= 4:2.8.1"),
         # without version, with epoch, with requirements
-        ({'epochs': {'requests': 4},
-          'requirements': {'requests': '1.2.3'}},
+        (_ctx(epochs={'requests': 4}, requirements={'requests': '1.2.3'}),
          "{{ py2pkg('requests') }}",
          "python-requests >= 4:1.2.3"),
         # without version, with epoch, with requirements, with py_versions
-        ({'epochs': {'requests': 4},
-          'requirements': {'requests': '1.2.3'}},
+        (_ctx(epochs={'requests': 4}, requirements={'requests': '1.2.3'}),
          "{{ py2pkg('requests', py_versions=['py2']) }}",
          "python2-requests >= 4:1.2.3"),
     )
     @unpack
     def test_render_func_py2pkg(self, context, string, expected_result):
-        template = self.env.from_string(string)
-        context.setdefault('skip_pyversion', ())
-        context.setdefault('spec_style', 'suse')
+        template = self._from_string(string)
         self.assertEqual(
             template.render(**context),
             expected_result)
 
     def test_render_func_epoch_without_epochs(self):
-        template = self.env.from_string(
+        template = self._from_string(
             "Epoch: {{ epoch('requests') }}")
         self.assertEqual(
             template.render(spec_style='suse', epochs={}, requirements={}),
             'Epoch: 0')
 
     def test_render_func_epoch_with_epochs(self):
-        template = self.env.from_string(
+        template = self._from_string(
             "Epoch: {{ epoch('requests') }}")
         self.assertEqual(
             template.render(spec_style='suse', epochs={'requests': 1},
                             requirements={}),
             'Epoch: 1')
 
+    def test_render_func_epoch_keyword(self):
+        template = self._from_string(
+            "Epoch: {{ epoch(value='requests') }}")
+        self.assertEqual(
+            template.render(spec_style='suse', epochs={'requests': 1},
+                            requirements={}),
+            'Epoch: 1')
+
     @data(
         # plain name
         ({'spec_style': 'suse', 'epochs': {}, 'requirements': {}},
@@ -299,7 +310,7 @@ class RenderspecTemplateFunctionTests(unittest.TestCase):
     @unpack
     def test_render_func_py2name(self, context, string, expected_result):
         """test the template context function called 'py2name()'"""
-        template = self.env.from_string(string)
+        template = self._from_string(string)
         self.assertEqual(
             template.render(**context),
             expected_result)
@@ -307,7 +318,7 @@ class RenderspecTemplateFunctionTests(unittest.TestCase):
     def test_render_func_py2name_raise(self):
         """py2name() called without parameter but no pypi_name context
         variable set"""
-        template = self.env.from_string(
+        template = self._from_string(
             "{{ py2name() }}")
         with self.assertRaises(TemplateRuntimeError):
             template.render(
@@ -334,7 +345,7 @@ class RenderspecTemplateFunctionTests(unittest.TestCase):
         # need to escape '{' and '}' here
         s = "{{% set upstream_version = '{}' %}}{{{{ py2rpmversion() }}}}"\
             .format(py_ver)
-        template = self.env.from_string(s)
+        template = self._from_string(s)
         self.assertEqual(
             template.render(**context),
             rpm_ver)
@@ -361,7 +372,7 @@ class RenderspecTemplateFunctionTests(unittest.TestCase):
         s = "{{% set upstream_version = '{}' %}}" \
             "{{% set rpm_release = '{}' %}}" \
             "{{{{ py2rpmrelease() }}}}".format(upstream_ver, rpm_release)
-        template = self.env.from_string(s)
+        template = self._from_string(s)
         self.assertEqual(
             template.render(**context),
             rpm_release_expected)
@@ -372,7 +383,7 @@ class RenderspecTemplateFunctionTests(unittest.TestCase):
         s = "{% set upstream_version = '3.20.0' %}" \
             "{% set pypi_name = 'oslo.concurrency' %}" \
             "{{ url_pypi() }}"
-        template = self.env.from_string(s)
+        template = self._from_string(s)
         self.assertEqual(
             template.render(**context),
             "https://files.pythonhosted.org/packages/source/o/"
@@ -400,6 +411,16 @@ class RenderspecVersionsTests(unittest.TestCase):
             ['django>=1.8,<1.10  # FOO BAR'])
         self.assertEqual(requires, {'django': '1.8'})
 
+    def test_with_release_versions(self):
+        requires = renderspec.versions.get_requirements(
+            ['foo>=1.10.0,>=1.9,<2.0', 'bar>=01.08.0'])
+        self.assertEqual(requires, {'foo': '1.9', 'bar': '1.8.0'})
+
+    def test_with_mixed_versions(self):
+        requires = renderspec.versions.get_requirements(
+            ['foo>=1.10.0,>=1.10.0rc1'])
+        self.assertEqual(requires, {'foo': '1.10.0rc1'})
+
     def test_with_multiple_versions_and_invalid_lowest(self):
         requires = renderspec.versions.get_requirements(
             ['sphinx>=1.1.2,!=1.1.0,!=1.3b1,<1.3  # BSD'])
@@ -423,24 +444,37 @@ class RenderspecCommonTests(unittest.TestCase):
         tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
         try:
             f1 = os.path.join(tmpdir, 'f1')
-            with open(f1, 'w+') as f:
-                f.write('paramiko>=1.16.0\n'
-                        'pyinotify>=0.9.6')
+            Path(f1).write_text('paramiko>=1.16.0\n'
+                                'pyinotify>=0.9.6')
             self.assertEqual(
                 renderspec._get_requirements([f1]),
                 {'paramiko': '1.16.0', 'pyinotify': '0.9.6'})
         finally:
             shutil.rmtree(tmpdir)
 
+    def test__get_requirements_changed_file(self):
+        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        try:
+            f1 = os.path.join(tmpdir, 'f1')
+            Path(f1).write_text('paramiko>=1.16.0')
+            self.assertEqual(renderspec._get_requirements([f1]),
+                             {'paramiko': '1.16.0'})
+            Path(f1).write_text('paramiko>=1.17.0')
+            # make sure the mtime differs even on coarse filesystems
+            st = os.stat(f1)
+            os.utime(f1, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertEqual(renderspec._get_requirements([f1]),
+                             {'paramiko': '1.17.0'})
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test__get_requirements_multiple_files(self):
         tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
         try:
             f1 = os.path.join(tmpdir, 'f1')
             f2 = os.path.join(tmpdir, 'f2')
-            with open(f1, 'w+') as f:
-                f.write('paramiko>=1.17.0  # LGPL')
-            with open(f2, 'w+') as f:
-                f.write('paramiko>=1.16.0  # LGPL')
+            Path(f1).write_text('paramiko>=1.17.0  # LGPL')
+            Path(f2).write_text('paramiko>=1.16.0  # LGPL')
             # we expect the second file was used (because mentioned last)
             self.assertEqual(renderspec._get_requirements([f1, f2]),
                              {'paramiko': '1.16.0'})
@@ -459,40 +493,172 @@ class RenderspecCommonTests(unittest.TestCase):
         tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
         try:
             f1 = os.path.join(tmpdir, 'test.spec.j2')
-            with open(f1, 'w+') as f:
-                f.write(template)
+            Path(f1).write_text(template)
             rendered = renderspec.generate_spec(
                 style, epochs, requirements, (), 'spec.j2', f1, None)
             self.assertTrue(rendered.endswith(expected_result))
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_generate_spec_changed_template(self):
+        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        try:
+            f1 = os.path.join(tmpdir, 'test.spec.j2')
+            for mtime, template, expected in (
+                    (1000000000, "{{ py2pkg('requests') }}",
+                     'python-requests'),
+                    (1000000001, "{{ py2pkg('oslo.config') }}",
+                     'python-oslo.config')):
+                Path(f1).write_text(template)
+                os.utime(f1, (mtime, mtime))
+                self.assertEqual(
+                    renderspec.generate_spec('suse', {}, {}, (), 'spec.j2',
+                                             f1, None),
+                    expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_generate_spec_unknown_format(self):
+        with self.assertRaises(Exception) as e_info:
+            renderspec.generate_spec('suse', {}, {}, (), 'foo', 'bar', None)
+        self.assertIn('Unknown input-template-format "foo"',
+                      str(e_info.exception))
+
+    def test_generate_spec_stream(self):
+        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        try:
+            f1 = os.path.join(tmpdir, 'test.spec.j2')
+            Path(f1).write_text("{{ py2pkg('requests') }}")
+            out = os.path.join(tmpdir, 'test.spec')
+            renderspec.generate_spec_stream(
+                'suse', {}, {}, (), 'spec.j2', f1, out).dump(
+                    out, encoding='utf-8')
+            with open(out, 'r') as f:
+                self.assertEqual(f.read(), 'python-requests')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_main_render_error_keeps_output(self):
+        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        try:
+            f1 = os.path.join(tmpdir, 'foo.spec.j2')
+            out = os.path.join(tmpdir, 'foo.spec')
+            # py2rpmversion() needs upstream_version so rendering fails
+            Path(f1).write_text("Name: python-oslo.config\n"
+                                "Version: {{ py2rpmversion() }}\n")
+            Path(out).write_text('old spec')
+            with patch('sys.argv', ['renderspec', '--spec-style', 'suse',
+                                    f1]):
+                with self.assertRaises(TemplateRuntimeError):
+                    renderspec.main()
+            self.assertEqual(Path(out).read_text(), 'old spec')
+            # the temporary file is removed again
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['foo.spec', 'foo.spec.j2'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_main_writes_output(self):
+        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        try:
+            f1 = os.path.join(tmpdir, 'foo.spec.j2')
+            out = os.path.join(tmpdir, 'foo.spec')
+            Path(f1).write_text("Name: {{ py2name('requests') }}\n")
+            Path(out).write_text('old spec')
+            os.chmod(out, 0o640)
+            with patch('sys.argv', ['renderspec', '--spec-style', 'suse',
+                                    f1]):
+                self.assertEqual(renderspec.main(), 0)
+            self.assertEqual(Path(out).read_text(),
+                             'Name: python-requests')
+            self.assertEqual(os.stat(out).st_mode & 0o777, 0o640)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['foo.spec', 'foo.spec.j2'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_main_writes_through_symlink(self):
+        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        try:
+            f1 = os.path.join(tmpdir, 'foo.spec.j2')
+            out = os.path.join(tmpdir, 'foo.spec')
+            real = os.path.join(tmpdir, 'real.spec')
+            Path(f1).write_text("Name: {{ py2name('requests') }}\n")
+            Path(real).write_text('old spec')
+            os.symlink(real, out)
+            with patch('sys.argv', ['renderspec', '--spec-style', 'suse',
+                                    f1]):
+                self.assertEqual(renderspec.main(), 0)
+            # the link is kept and the spec is written into its target
+            self.assertTrue(os.path.islink(out))
+            self.assertEqual(Path(real).read_text(),
+                             'Name: python-requests')
+        finally:
+            shutil.rmtree(tmpdir)
 
+    def test_process_args_fast(self):
+        # the fast path must give the same result as argparse
+        with patch('sys.argv', ['renderspec', 'foo.spec.j2']):
+            self.assertEqual(renderspec._process_args_fast(['foo.spec.j2']),
+                             renderspec.process_args())
+
+    @data(
+        ['-foo.spec.j2'],
+        ['foo.spec'],
+        ['--spec-style', 'fedora', 'foo.spec.j2'],
+        [],
+    )
+    def test_process_args_fast_fallback(self, argv):
+        self.assertIsNone(renderspec._process_args_fast(argv))
+
+
+@ddt
 class RenderspecDistroDetection(unittest.TestCase):
     def test_is_fedora(self):
-        self.assertTrue(renderspec._is_fedora("CentOS Linux"))
-        self.assertTrue(renderspec._is_fedora("Fedora"))
-        self.assertTrue(renderspec._is_fedora("Red Hat Enterprise Linux 7.2"))
-        self.assertFalse(renderspec._is_fedora("SUSE Linux Enterprise Server"))
-
-    def test_get_default_distro(self):
-        import platform
-        platform.linux_distribution = Mock(
-            return_value=('SUSE Linux Enterprise Server ', '12', 'x86_64'))
-        self.assertEqual(renderspec._get_default_distro(),
-                         "suse")
-        platform.linux_distribution = Mock(
-            return_value=('Fedora', '24', 'x86_64'))
-        self.assertEqual(renderspec._get_default_distro(), "fedora")
-        platform.linux_distribution = Mock(
-            return_value=('Red Hat Enterprise Linux Server', '7.3', 'x86_64'))
-        self.assertEqual(renderspec._get_default_distro(), "fedora")
-        platform.linux_distribution = Mock(
-            return_value=('CentOS Linux', '7.3', 'x86_64'))
-        self.assertEqual(renderspec._get_default_distro(), "fedora")
-        platform.linux_distribution = Mock(
-            return_value=('debian', '7.0', 'x86_64'))
-        self.assertEqual(renderspec._get_default_distro(), "unknown")
+        for distname, expected in (("CentOS Linux", True),
+                                   ("Fedora", True),
+                                   ("Red Hat Enterprise Linux 7.2", True),
+                                   ("SUSE Linux Enterprise Server", False)):
+            with self.subTest(distname=distname):
+                self.assertIs(renderspec._is_fedora(distname), expected)
+
+    @data(
+        ({'ID': 'sles', 'ID_LIKE': 'suse'}, 'suse'),
+        ({'ID': 'fedora'}, 'fedora'),
+        ({'ID': 'rhel', 'ID_LIKE': 'fedora'}, 'fedora'),
+        ({'ID': 'centos', 'ID_LIKE': 'rhel fedora'}, 'fedora'),
+        ({'ID': 'debian'}, 'unknown'),
+        ({}, 'unknown'),
+    )
+    @unpack
+    def test_get_default_distro(self, os_release, expected):
+        with patch('renderspec._os_release', return_value=os_release):
+            self.assertEqual(renderspec._get_default_distro(), expected)
+
+    def test_get_default_pyskips(self):
+        with patch('renderspec._os_release',
+                   return_value={'ID': 'centos', 'VERSION_ID': '7'}):
+            self.assertEqual(renderspec._get_default_pyskips('fedora'), 'py3')
+        with patch('renderspec._os_release',
+                   return_value={'ID': 'centos', 'VERSION_ID': '8'}):
+            self.assertIsNone(renderspec._get_default_pyskips('fedora'))
+
+    def test_os_release(self):
+        os_release = ('NAME="openSUSE Leap"\n'
+                      'ID="opensuse-leap"\n'
+                      'ID_LIKE="suse opensuse"\n'
+                      '\n'
+                      'VERSION_ID="15.5"\n')
+        renderspec._os_release.cache_clear()
+        try:
+            with patch('builtins.open', mock_open(read_data=os_release)):
+                self.assertEqual(renderspec._os_release(),
+                                 {'NAME': 'openSUSE Leap',
+                                  'ID': 'opensuse-leap',
+                                  'ID_LIKE': 'suse opensuse',
+                                  'VERSION_ID': '15.5'})
+        finally:
+            renderspec._os_release.cache_clear()
 
 
 class RenderspecDistTeamplatesTests(unittest.TestCase):
@@ -514,14 +680,12 @@ class RenderspecDistTeamplatesTests(unittest.TestCase):
         try:
             # create .spec template
             base_path = os.path.join(tmpdir, 'foo.spec.j2')
-            with open(base_path, 'w+') as f:
-                f.write(base_txt)
+            Path(base_path).write_text(base_txt)
             # create custom dist template
             dt_dir = os.path.join(tmpdir, 'dist-templates')
             os.mkdir(dt_dir)
             dt_path = os.path.join(dt_dir, 'loldistro.spec.j2')
-            with open(dt_path, 'w+') as f:
-                f.write(dt_txt)
+            Path(dt_path).write_text(dt_txt)
             # mock this to use testing dist-tempaltes folder
             mock_dt_path.return_value = dt_dir
 
@@ -531,56 +695,83 @@ class RenderspecDistTeamplatesTests(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_dist_templates_not_found(self):
+        env = Environment(loader=renderspec.distloader.RenderspecLoader(
+            template_fn='/does/not/exist.spec.j2'))
+        with self.assertRaises(TemplateNotFound):
+            env.get_template('.spec')
+
 
 @ddt
 class RenderspecUtilsTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """one temporary directory for all tests of the class"""
+        cls._tmproot = tempfile.mkdtemp(prefix='renderspec-test_')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._tmproot)
+
+    def setUp(self):
+        """each test gets its own empty directory below the shared one"""
+        self.tmpdir = os.path.join(self._tmproot, self.id())
+        os.mkdir(self.tmpdir)
+
+    def _touch(self, path):
+        """create an empty file"""
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o644))
+
     def _write_pkg_info(self, destdir, version='5.10.0'):
         """write a PKG-INFO file into destdir"""
         f1 = os.path.join(destdir, 'PKG-INFO')
-        with open(f1, 'w+') as f:
-            f.write('Metadata-Version: 1.1\n'
-                    'Name: oslo.messaging\n'
-                    'Version: %s' % (version))
+        Path(f1).write_text('Metadata-Version: 1.1\n'
+                            'Name: oslo.messaging\n'
+                            'Version: %s' % (version))
 
-    def test__extract_archive_to_tempdir_no_file(self):
+    def test__get_version_from_archive_no_archive(self):
+        f1 = os.path.join(self.tmpdir, 'foo.tar.gz')
+        Path(f1).write_text('not an archive')
         with self.assertRaises(Exception) as e_info:
-            with renderspec.utils._extract_archive_to_tempdir("foobar"):
-                self.assertIn("foobar", str(e_info))
-
-    def test__find_pkg_info(self):
-        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
-        try:
-            self._write_pkg_info(tmpdir)
-            # we expect _find_pkg_info() to find the file in the tmpdir
-            self.assertEqual(
-                renderspec.utils._find_pkg_info(tmpdir),
-                os.path.join(tmpdir, 'PKG-INFO')
-            )
-        finally:
-            shutil.rmtree(tmpdir)
+            renderspec.utils._get_version_from_archive(f1)
+        self.assertIn('Not a tar or zip file', str(e_info.exception))
+
+    @data('gztar', 'bztar', 'zip')
+    def test__get_version_from_archive(self, archive_format):
+        tmpdir = self.tmpdir
+        # a nested PKG-INFO (e.g. from the egg-info) must not be used
+        srcdir = os.path.join(tmpdir, 'foo-5.10.0')
+        os.makedirs(os.path.join(srcdir, 'foo.egg-info'))
+        self._write_pkg_info(srcdir, '5.10.0')
+        self._write_pkg_info(os.path.join(srcdir, 'foo.egg-info'), '1.0')
+        archive = shutil.make_archive(srcdir, archive_format,
+                                      tmpdir, 'foo-5.10.0')
+        self.assertEqual(
+            renderspec.utils._get_version_from_archive(archive),
+            '5.10.0')
 
-    def test__find_pkg_info_not_found(self):
-        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
-        try:
-            self.assertEqual(
-                renderspec.utils._find_pkg_info(tmpdir),
-                None
-            )
-        finally:
-            shutil.rmtree(tmpdir)
+    @data(
+        # empty Version header. The next header is not the version
+        ('Metadata-Version: 2.1\nVersion:\nSummary: foo\n', None),
+        # a Version line in the description is not a header
+        ('Metadata-Version: 2.1\nName: foo\n\nVersion: 1.0.0\n', None),
+        ('Metadata-Version: 2.1\nVersion: 1.2.3 \r\n\nVersion: 1.0\n',
+         '1.2.3'),
+    )
+    @unpack
+    def test__get_version_from_archive_pkg_info(self, pkg_info, expected):
+        srcdir = os.path.join(self.tmpdir, 'foo-1.2.3')
+        os.mkdir(srcdir)
+        Path(srcdir, 'PKG-INFO').write_text(pkg_info)
+        archive = shutil.make_archive(srcdir, 'gztar', self.tmpdir,
+                                      'foo-1.2.3')
+        self.assertEqual(
+            renderspec.utils._get_version_from_archive(archive), expected)
 
-    def test__version_from_pkg_info(self):
-        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
-        version = '5.10.0'
-        try:
-            self._write_pkg_info(tmpdir, version)
-            pkg_info_file = renderspec.utils._find_pkg_info(tmpdir)
-            self.assertEqual(
-                renderspec.utils._get_version_from_pkg_info(pkg_info_file),
-                version
-            )
-        finally:
-            shutil.rmtree(tmpdir)
+    def test__get_version_from_archive_no_file(self):
+        with self.assertRaises(Exception) as e_info:
+            renderspec.utils._get_version_from_archive("foobar")
+        self.assertIn("foobar", str(e_info.exception))
 
     @data(
         (['foo-1.2.3.tar.gz'], 'foo', ['foo-1.2.3.tar.gz']),
@@ -592,32 +783,39 @@ class RenderspecUtilsTests(unittest.TestCase):
     )
     @unpack
     def test__find_archives(self, archives, pypi_name, expected):
-        tmpdir = tempfile.mkdtemp(prefix='renderspec-test_')
+        tmpdir = self.tmpdir
         expected = [os.path.join(tmpdir, e) for e in expected]
-        try:
-            for a in archives:
-                open(os.path.join(tmpdir, a), 'w').close()
-                time.sleep(0.1)
-            self.assertEqual(
-                renderspec.utils._find_archives(tmpdir, pypi_name),
-                expected
-            )
-        finally:
-            shutil.rmtree(tmpdir)
+        for i, a in enumerate(archives):
+            path = os.path.join(tmpdir, a)
+            self._touch(path)
+            # set increasing mtimes instead of waiting between the files
+            os.utime(path, (1000000000 + i, 1000000000 + i))
+        self.assertEqual(
+            renderspec.utils._find_archives(tmpdir, pypi_name),
+            expected
+        )
 
     def test__find_archives_multiple_dirs(self):
-        tmpdir1 = tempfile.mkdtemp(prefix='renderspec-test_')
-        tmpdir2 = tempfile.mkdtemp(prefix='renderspec-test_')
-        try:
-            open(os.path.join(tmpdir2, 'foo-1.2.3.tar.xz'), 'w').close()
-            self.assertEqual(
-                renderspec.utils._find_archives([None, tmpdir1, tmpdir2],
-                                                'foo'),
-                [os.path.join(tmpdir2, 'foo-1.2.3.tar.xz')]
-            )
-        finally:
-            shutil.rmtree(tmpdir1)
-            shutil.rmtree(tmpdir2)
+        tmpdir1 = os.path.join(self.tmpdir, '1')
+        tmpdir2 = os.path.join(self.tmpdir, '2')
+        os.mkdir(tmpdir1)
+        os.mkdir(tmpdir2)
+        self._touch(os.path.join(tmpdir2, 'foo-1.2.3.tar.xz'))
+        self.assertEqual(
+            renderspec.utils._find_archives([None, tmpdir1, tmpdir2],
+                                            'foo'),
+            [os.path.join(tmpdir2, 'foo-1.2.3.tar.xz')]
+        )
+
+    def test__find_archives_duplicate_dirs(self):
+        tmpdir = self.tmpdir
+        self._touch(os.path.join(tmpdir, 'foo-1.2.3.tar.gz'))
+        os.mkdir(os.path.join(tmpdir, 'foo-1.2.4.zip'))
+        self.assertEqual(
+            renderspec.utils._find_archives(
+                [tmpdir, os.path.join(tmpdir, '.')], 'foo'),
+            [os.path.join(tmpdir, 'foo-1.2.3.tar.gz')]
+        )
 
     def test__find_archives_only_no_dir(self):
         self.assertEqual(renderspec.utils._find_archives([None], 'foo'), [])